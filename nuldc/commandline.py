@@ -20,9 +20,11 @@ all_records_option = typer.Option(False, "--all", help="Get all records")
 
 
 def build_params(as_format, all_records, fields, exclude_fields):
-    """Build API parameters dictionary"""
+    """Build API parameters dictionary. Paging through all records lets the
+    page_sizer pick the page size"""
     params = {"as": as_format, "size": "200"}
     if all_records:
+        params["size"] = str(helpers.page_sizer.size())
         params["sort"] = "id:asc"
 
     if fields:
@@ -126,9 +128,19 @@ def xml(
 def callback(
     ctx: typer.Context,
     version: bool = typer.Option(
-        False, "--version", help="Show version and exit")
+        False, "--version", help="Show version and exit"),
+    min_size: int = typer.Option(
+        helpers.page_sizer.min_size, "--min-size", min=1,
+        help="Smallest page size to use when paging with --all"),
+    max_size: int = typer.Option(
+        helpers.page_sizer.max_size, "--max-size", min=1,
+        help="Largest page size to use when paging with --all")
 ):
     """NULDC - Python helpers consuming the DCAPI."""
+    try:
+        helpers.page_sizer.set_limits(min_size, max_size)
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
     if version:
         try:
             v = metadata.version("nuldc")
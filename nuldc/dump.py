@@ -1,9 +1,9 @@
 """
 This script is an opinionated dump of the nuldc metadata.
 It should be run from the folder in which you want to create
-an archive of nul's digital collection metadata. It is run
-with no arguments. First it looks to see if there's files
-for each type:
+an archive of nul's digital collection metadata. It runs once
+with no arguments, see `nuldump --help` for the options. First it
+looks to see if there's files for each type:
 
     - json
     - xml
@@ -11,23 +11,54 @@ for each type:
 
 It then looks for an `_updated_at.txt` file. If one does not
 exist it starts a clean dump. If one does exist it reads the first
-line and performs a date-based search with it on `indexed_at`.
-After the run is complete it updates the _updated_at.txt file.
+line and searches for works with an `indexed_at` at or after it.
+After the run is complete it updates the _updated_at.txt file with
+the latest `indexed_at` it saw, down to the millisecond, e.g.
+2024-03-05T17:20:31.123Z. Older files with just a date still work.
 
-If you want to start from a specific date, simply tweak
+If you want to start from a specific date or time, simply tweak
 _updated_at.txt.
+
+With --watch it keeps running, polling every --interval seconds for
+newly indexed works and dumping their collections as they change.
+Each poll is a single aggregation request for each collection's
+latest indexed_at and number of works, and a collection is only
+dumped again when one of those changes, so idle polls are cheap.
+Changed collections go on a bounded queue that a worker thread
+drains, and every request shares the one helpers.session connection
+pool. Ctrl-C or SIGTERM lets the worker finish the collection it's
+on before exiting.
+
+Both modes look back --overlap seconds past _updated_at.txt to
+catch works that take a moment to show up in search. If a collection
+keeps failing to dump, the watcher holds _updated_at.txt back for it
+and says so, until it succeeds or drops out of that window.
+
+Files are written through a temp file and renamed into place, and
+a sha256 of each collection's records is kept in _manifest.json.
+Collections whose records match the manifest are not rewritten.
+
+Page sizes are tuned as collections are dumped, pass --min-size
+and --max-size to bound them.
 """
 
 
 from nuldc import helpers
+import typer
 import json
+import hashlib
+import queue
 import re
-import datetime
 import os
+import signal
 import sys
+import threading
+import time
 
 
 API = "https://api.dc.library.northwestern.edu/api/v2"
+MANIFEST = "_manifest.json"
+UPDATED_AT = "_updated_at.txt"
 
 
 def slugify(s):
@@ -41,78 +72,321 @@ def slugify(s):
     return s
 
 
-def save_files(basename, data):
-    """takes a base filename and saves json, csv, and xml"""
+def load_manifest():
+    """returns the basename to records hash map from the last dump"""
+
+    if not os.path.isfile(MANIFEST):
+        return {}
+    with open(MANIFEST, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest):
+    """writes the manifest out atomically"""
+
+    with helpers.atomic_open(MANIFEST, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def load_updated_at():
+    """returns the indexed_at high water mark from the last dump"""
+
+    if not os.path.isfile(UPDATED_AT):
+        return None
+    with open(UPDATED_AT) as f:
+        return f.readline().strip() or None
+
+
+def save_updated_at(updated_at):
+    """writes the indexed_at high water mark out atomically"""
+
+    with helpers.atomic_open(UPDATED_AT, 'w') as f:
+        f.write(updated_at)
+
+
+def records_hash(data):
+    """returns a sha256 of the records in a set of results"""
+
+    records = json.dumps(data.get('data'), sort_keys=True).encode('utf-8')
+    return hashlib.sha256(records).hexdigest()
+
+
+def save_files(basename, data, manifest=None):
+    """takes a base filename and saves json, csv, and xml. If a manifest
+    is passed in and it has the same records hash for basename, and the
+    files are still there, nothing is written. Returns True if the files
+    were written"""
+
+    paths = [f"json/{basename}.json",
+             f"xml/{basename}.xml",
+             f"csv/{basename}.csv"]
+    digest = records_hash(data)
+    if manifest is not None and manifest.get(basename) == digest and all(
+            os.path.isfile(p) for p in paths):
+        return False
 
     # make the directories if they don't exist
     for d in ['json', 'xml', 'csv']:
         if not os.path.isdir(d):
             os.mkdir(d)
 
-    with open(f"json/{basename}.json", 'w', encoding='utf-8') as f:
+    with helpers.atomic_open(paths[0], 'w', encoding='utf-8') as f:
         json.dump(data.get('data'), f)
 
-    helpers.save_xml(data, f'xml/{basename}.xml')
+    helpers.save_xml(data, paths[1])
 
     headers, values = helpers.sort_fields_and_values(data)
-    helpers.save_as_csv(headers, values, f'csv/{basename}.csv')
+    helpers.save_as_csv(headers, values, paths[2])
 
+    if manifest is not None:
+        manifest[basename] = digest
+        save_manifest(manifest)
+    return True
 
-def dump_collection(col_id):
+
+def save_collection(col_id, manifest=None):
     """ Takes a collection id and grabs metadata then dumps into
-    json, xml, and csv files"""
+    json, xml, and csv files, skipping them if the manifest says
+    they're unchanged. Errors are raised"""
 
     params = {
         "query": f"collection.id:{col_id}",
-        "size": "25",
+        "size": str(helpers.page_sizer.size()),
         "sort": "id:asc",
         "_source_excludes": "embedding"}
+    data = helpers.get_search_results(API,
+                                      "works",
+                                      params,
+                                      all_results=True,
+                                      )
+    col_title = data['data'][0]['collection']['title']
+    filename = f"{slugify(col_title)}-{col_id}"
+    if not save_files(filename, data, manifest):
+        print(f"{filename} unchanged, skipping")
+
+
+def dump_collection(col_id, manifest=None):
+    """Like save_collection but exits on errors"""
+
     try:
-        data = helpers.get_search_results(API,
-                                          "works",
-                                          params,
-                                          all_results=True,
-                                          )
-        col_title = data['data'][0]['collection']['title']
-        filename = f"{slugify(col_title)}-{col_id}"
-        save_files(filename, data)
+        save_collection(col_id, manifest)
     except Exception as e:
         sys.exit(f"Error with collection {col_id}: {e} ")
 
 
-def dump_collections(query_string):
-    """This dumps collections from a collectionlist."""
+def changed_collections(since=None, overlap=0):
+    """Returns a dict of collection ids that have works indexed at or after
+    since, minus overlap seconds, along with the max indexed_at overall as a
+    string. Each collection has the max indexed_at agg of all its works plus
+    the number of works it has under 'works'. since can be anything
+    opensearch takes as a date. Without since it returns every
+    collection"""
 
-    search_url = f'{API}/search'
-    # get collections list
-    collections = helpers.aggregate_by(search_url,
-                                       query_string,
-                                       "collection.id",
-                                       1000)
-    # grab data for each collection and dump
-    collections = collections.json(
-    )['aggregations']['collection.id']['buckets']
+    sub_aggs = {"indexed_at": {"max": {"field": "indexed_at"}}}
+    if since:
+        sub_aggs["recent"] = {"filter": {"range": {
+            "indexed_at": {"gte": f"{since}||-{overlap}s"}}}}
+    # the buckets cover whole collections, so a work that shows up late
+    # changes the count even when it doesn't change the max indexed_at
+    response = helpers.aggregate_by(
+        f'{API}/search', "*", "collection.id", 1000, sub_aggs=sub_aggs,
+        order={"indexed_at": "desc"})
+    buckets = response.json()['aggregations']['collection.id']['buckets']
 
-    for c in collections:
-        dump_collection(c['key'])
+    collections = {b['key']: dict(b['indexed_at'], works=b['doc_count'])
+                   for b in buckets
+                   if not since or b['recent']['doc_count']}
+    latest = max(collections.values(),
+                 key=lambda i: i.get('value') or 0, default={})
+    return collections, latest.get('value_as_string')
 
-    with open('_updated_at.txt', 'w') as f:
-        f.write(f"{datetime.datetime.now().strftime('%Y-%m-%d')}")
 
+def dump_collections(since=None, overlap=300):
+    """This dumps every collection with works indexed since the high water
+    mark, looking back overlap seconds for works that were slow to show up
+    in search, then moves the mark up to the latest indexed_at seen."""
 
-def main():
+    collections, updated_at = changed_collections(since, overlap)
+
+    manifest = load_manifest()
+    for col_id in collections:
+        dump_collection(col_id, manifest)
+
+    if updated_at:
+        save_updated_at(updated_at)
+
+
+class Watcher:
+    """Polls for newly indexed works and dumps their collections as they
+    change. poll puts collections whose latest indexed_at or number of
+    works changed since they were last dumped on a bounded queue, followed
+    by a checkpoint, and a worker thread runs apply on each item. At a
+    checkpoint the worker moves _updated_at.txt up, holding it back to the
+    oldest change that failed so it is retried on the next poll."""
+
+    STOP = (None, None)
+
+    def __init__(self, overlap=300, queue_size=100):
+        self.overlap = overlap
+        self.work = queue.Queue(maxsize=queue_size)
+        # collection id -> (max indexed_at, works) that was dumped
+        self.applied = {}
+        # collection id -> (max indexed_at, works) waiting on the queue
+        self.queued = {}
+        # collection id -> collection from changed_collections that failed
+        self.failed = {}
+        self.since = load_updated_at()
+        self.manifest = load_manifest()
+        self.stopping = threading.Event()
+
+    @staticmethod
+    def version(collection):
+        """what a collection from changed_collections is compared by"""
+        return collection.get('value') or 0, collection.get('works')
+
+    def poll(self):
+        """queues the collections that changed since they were last dumped
+        or queued, then a checkpoint with the latest indexed_at and the
+        collections that were seen. Blocks while the queue is full"""
+
+        collections, updated_at = changed_collections(self.since,
+                                                      self.overlap)
+        for col_id, collection in collections.items():
+            version = self.version(collection)
+            if version in (self.queued.get(col_id),
+                           self.applied.get(col_id)):
+                continue
+            self.queued[col_id] = version
+            self.work.put((col_id, collection))
+        self.work.put((None, (updated_at, set(collections))))
+
+    def apply(self, item):
+        """dumps a queued collection, or moves the mark up at a checkpoint"""
+
+        col_id, collection = item
+        if col_id is None:
+            self.checkpoint(*collection)
+            return
+
+        version = self.version(collection)
+        try:
+            save_collection(col_id, self.manifest)
+            self.applied[col_id] = version
+            self.failed.pop(col_id, None)
+        except BaseException as e:
+            # the paging helpers sys.exit on errors, so catch those too
+            print(f"Error with collection {col_id}: {e!r}")
+            self.failed[col_id] = collection
+        finally:
+            # a newer change may have been queued behind this one
+            if self.queued.get(col_id) == version:
+                del self.queued[col_id]
+
+    def checkpoint(self, updated_at, seen):
+        """everything queued before this checkpoint has been tried, so move
+        the mark up to updated_at or the oldest failure. Failures that
+        weren't seen in the poll won't be retried, so they're dropped"""
+
+        for col_id in set(self.failed) - seen:
+            print(f"Giving up on collection {col_id}, it failed to dump and "
+                  "no longer has recently indexed works")
+            del self.failed[col_id]
+
+        marks = [f['value_as_string'] for f in self.failed.values()]
+        if updated_at:
+            marks.append(updated_at)
+        if not marks:
+            return
+        checkpoint = min(marks)
+        if self.failed:
+            print(f"{UPDATED_AT} held at {checkpoint} until collections "
+                  f"{', '.join(sorted(self.failed))} dump")
+        if checkpoint != self.since:
+            save_updated_at(checkpoint)
+            self.since = checkpoint
+
+    def work_forever(self):
+        """applies queued items until it gets STOP. Once stopping is set
+        the rest of the queue is skipped. Never dies on an error"""
+
+        while True:
+            item = self.work.get()
+            try:
+                if item is self.STOP:
+                    return
+                if not self.stopping.is_set():
+                    self.apply(item)
+            except BaseException as e:
+                print(f"Error in watch worker: {e!r}")
+            finally:
+                self.work.task_done()
+
+    def run(self, interval=60):
+        """polls every interval seconds until interrupted, then waits for
+        the worker to finish the collection it's on"""
+
+        worker = threading.Thread(target=self.work_forever, daemon=True)
+        worker.start()
+        # treat SIGTERM like Ctrl-C so the worker gets shut down cleanly
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        print(f"watching for works indexed since {self.since}, "
+              f"polling every {interval}s")
+        try:
+            while True:
+                try:
+                    self.poll()
+                except Exception as e:
+                    print(f"Error polling for changes: {e}")
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print("stopping, waiting on the current collection")
+            self.stopping.set()
+            self.work.put(self.STOP)
+            worker.join()
+
+
+def dump(
+    min_size: int = typer.Option(
+        helpers.page_sizer.min_size, "--min-size", min=1,
+        help="Smallest page size to request"),
+    max_size: int = typer.Option(
+        helpers.page_sizer.max_size, "--max-size", min=1,
+        help="Largest page size to request"),
+    watch_mode: bool = typer.Option(
+        False, "--watch",
+        help="Keep running and dump collections as works are indexed"),
+    interval: int = typer.Option(
+        60, "--interval", min=0, help="Seconds between polls with --watch"),
+    overlap: int = typer.Option(
+        300, "--overlap", min=0,
+        help="Seconds to look back past the last indexed_at"),
+    queue_size: int = typer.Option(
+        100, "--queue-size", min=1,
+        help="Most collections waiting to be dumped with --watch")
+):
     """ Grabs all metadata. If there is an _updated_at.txt file it will
-    only get collections containign works updated since its modified
-    date. """
+    only get collections containign works indexed since the time in it. """
+
+    try:
+        helpers.page_sizer.set_limits(min_size, max_size)
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
 
-    if os.path.isfile("_updated_at.txt"):
-        with open('_updated_at.txt') as f:
-            updated = f.readline().strip()
+    if watch_mode:
+        Watcher(overlap, queue_size).run(interval)
+        return
 
-        query = f"indexed_at: >={updated}"
-        print(f"looking for collections with works updated since {query}")
+    updated = load_updated_at()
+    if updated:
+        print("looking for collections with works updated since "
+              f"{updated}")
     else:
         print("can't find updated since file, rebuilding all collections")
-        query = "*"
 
-    dump_collections(query)
+    dump_collections(updated, overlap)
+
+
+def main():
+    """nuldump entry point"""
+    typer.run(dump)
@@ -4,7 +4,12 @@ import urllib3
 import unicodecsv as csv
 import tqdm
 import dicttoxml
+import contextlib
+import os
+import stat
 import sys
+import tempfile
+import time
 
 api_base_url = "https://api.dc.library.northwestern.edu/api/v2"
 HIT_LIMIT = 49999
@@ -18,6 +23,95 @@ session = requests.Session()
 adapter = HTTPAdapter(max_retries=retries)
 session.mount('https://', adapter)
 
+# the only way to read the umask is to set it, so do it once at import
+# rather than while other threads might be creating files
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+class PageSizer:
+    """Picks a page size for paged queries from the observed cost of the
+    pages fetched so far. Bytes and seconds per record are tracked as a
+    moving average and the size is whatever keeps a page under both targets,
+    clamped between min_size and max_size. Seconds per record only come from
+    full pages, since the fixed cost of a request would make the last page
+    of a query, or a whole small collection, look slow per record. The API
+    fixes the size of a query in its next_url, so a new size takes effect on
+    the next query. Until a page has been measured it uses initial_size.
+    Only opensearch json pages are measured, IIIF pages are not."""
+
+    def __init__(self, min_size=10, max_size=500, initial_size=200,
+                 target_bytes=5_000_000, target_seconds=5.0, smoothing=0.5):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.initial_size = initial_size
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+        self.smoothing = smoothing
+        self.bytes_per_record = None
+        self.seconds_per_record = None
+
+    def set_limits(self, min_size, max_size):
+        """sets the page size bounds, raising ValueError if they're not
+        positive or min_size is bigger than max_size"""
+
+        if min_size < 1 or max_size < 1:
+            raise ValueError("page sizes must be at least 1")
+        if min_size > max_size:
+            raise ValueError(f"min size {min_size} is bigger than max size "
+                             f"{max_size}")
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def _average(self, current, observed):
+        if current is None:
+            return observed
+        return self.smoothing * observed + (1 - self.smoothing) * current
+
+    def record(self, nbytes, seconds, nrecords, full_page=True):
+        """adds a page's size, latency, and record count to the averages.
+        The latency of a page that wasn't full is left out"""
+
+        if not nrecords:
+            return
+        self.bytes_per_record = self._average(self.bytes_per_record,
+                                              nbytes / nrecords)
+        if full_page:
+            self.seconds_per_record = self._average(self.seconds_per_record,
+                                                    seconds / nrecords)
+
+    def size(self):
+        """returns the page size to use for the next query"""
+
+        if not self.bytes_per_record:
+            size = self.initial_size
+        else:
+            size = self.target_bytes / self.bytes_per_record
+        if self.seconds_per_record:
+            size = min(size, self.target_seconds / self.seconds_per_record)
+        return max(self.min_size, min(self.max_size, int(size)))
+
+
+page_sizer = PageSizer()
+
+
+def get_page(url, params=None):
+    """GETs a page of json results and records its cost with the
+    page_sizer"""
+
+    start = time.perf_counter()
+    response = session.get(url, params=params)
+    page = response.json()
+    elapsed = time.perf_counter() - start
+
+    records = page.get('data') if isinstance(page, dict) else None
+    if isinstance(records, list):
+        limit = (page.get('pagination') or {}).get('limit')
+        full_page = limit is None or len(records) >= int(limit)
+        page_sizer.record(len(response.content), elapsed, len(records),
+                          full_page)
+    return page
+
 
 def get_all_iiif(start_manifest, total_pages, total_hits):
     """ takes items from a IIIF manifest and returns the next_page
@@ -69,12 +163,13 @@ def get_all_search_results(start_results):
 
     # add a progress bar when you get a lot of results
     pbar = tqdm.tqdm(total=total_pages, initial=1)
+    pbar.set_postfix(size=results['pagination'].get('limit'))
 
     # loop through the results
     while next_url:
         next_results = None
         try:
-            next_results = session.get(next_url).json()
+            next_results = get_page(next_url)
             results['data'] = results['data'] + next_results.get('data')
             next_url = next_results.get('pagination').get('next_url')
             pbar.update(1)
@@ -136,11 +231,11 @@ def get_nested_field(field, source_dict):
 
 def get_search_results(api_base_url, model, parameters,
                        all_results=False):
-    """iterates through and grabs the search results. Sets a default pagelimit
-    to 200"""
+    """iterates through and grabs the search results. The page size comes
+    from parameters, see page_sizer for picking one when paging"""
 
     url = f"{api_base_url}/search/{model}"
-    search_results = session.get(url, params=parameters).json()
+    search_results = get_page(url, parameters)
 
     # Get all results as IIIF
     if all_results and parameters.get('as') == 'iiif':
@@ -185,10 +280,52 @@ def normalize_format(field):
     return str(field)
 
 
+@contextlib.contextmanager
+def atomic_open(output_file, mode='wb', **kwargs):
+    """opens a temp file next to output_file and renames it over
+    output_file once the block finishes, so readers never see a partial
+    file. The temp file is removed if the block raises. Symlinks are
+    followed and an existing file keeps its permissions. Anything that
+    isn't a regular file, like /dev/stdout, is just opened and written"""
+
+    if os.path.exists(output_file) and not os.path.isfile(output_file):
+        with open(output_file, mode, **kwargs) as f:
+            yield f
+        return
+
+    output_file = os.path.realpath(output_file)
+    try:
+        permissions = stat.S_IMODE(os.stat(output_file).st_mode)
+    except FileNotFoundError:
+        permissions = 0o666 & ~UMASK
+
+    directory = os.path.dirname(output_file)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=f'.{os.path.basename(output_file)}.')
+    try:
+        # mkstemp makes owner-only files, give it the usual permissions
+        os.chmod(tmp_path, permissions)
+        f = open(fd, mode, **kwargs)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    try:
+        with f:
+            yield f
+            # get the data on disk before the rename can be
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, output_file)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
 def save_as_csv(headers, values, output_file):
     """outputs a CSV using unicodecsv"""
 
-    with open(output_file, 'wb') as csvfile:
+    with atomic_open(output_file, 'wb') as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(headers)
         for row in values:
@@ -208,7 +345,7 @@ def save_xml(opensearch_results, output_file):
     opensearch_results['data'] = data
     xml = dicttoxml.dicttoxml(opensearch_results, attr_type=False)
 
-    with open(output_file, 'wb') as xmlfile:
+    with atomic_open(output_file, 'wb') as xmlfile:
         xmlfile.write(xml)
 
 
@@ -237,17 +374,20 @@ def sort_fields_and_values(opensearch_results, fields=[]):
     return fields, values
 
 
-def aggregate_by(search_url, query_string, agg, size):
+def aggregate_by(search_url, query_string, agg, size, sub_aggs=None,
+                 order=None):
     """ Takes a base url and a query string query and aggs on a single
-    agg field"""
+    agg field. query_string can also be an opensearch query dict, sub_aggs
+    are nested under each bucket of the agg, and order sorts the buckets"""
+
+    if isinstance(query_string, dict):
+        query_dsl = query_string
+    else:
+        query_dsl = {"query_string": {"query": query_string}}
 
     query = {
         "size": "0",
-        "query": {
-            "query_string": {
-                "query": query_string
-            }
-        },
+        "query": query_dsl,
         "aggs": {
             agg: {
                 "terms": {
@@ -257,5 +397,9 @@ def aggregate_by(search_url, query_string, agg, size):
             }
         }
     }
+    if sub_aggs:
+        query['aggs'][agg]['aggs'] = sub_aggs
+    if order:
+        query['aggs'][agg]['terms']['order'] = order
 
     return session.post(search_url, json=query)
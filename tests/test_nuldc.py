@@ -1,12 +1,18 @@
+import os
+import sys
 import pytest
-from nuldc.helpers import (get_search_results,
+from nuldc import dump, helpers
+from nuldc.commandline import build_params
+from nuldc.helpers import (atomic_open,
+                           get_search_results,
                            get_all_search_results,
                            get_all_iiif,
                            get_collection_by_id,
                            get_nested_field,
                            get_work_by_id,
                            normalize_format,
-                           sort_fields_and_values
+                           sort_fields_and_values,
+                           PageSizer
                            )
 
 
@@ -193,3 +199,302 @@ def test_sort_fields_and_values(mock_dcapi):
                 some_fields == ['contributor'],
                 some_values[0] == [expected_contributors]]
                )
+
+
+def test_page_sizer():
+    sizer = PageSizer(min_size=10, max_size=500, initial_size=100,
+                      target_bytes=100_000, target_seconds=10)
+    initial = sizer.size()
+    # 1kb and 10ms a record should fill up the byte target at 100 records
+    sizer.record(25_000, .25, 25)
+    by_bytes = sizer.size()
+    # really heavy records get clamped to the min
+    heavy = PageSizer(min_size=10, max_size=500, target_bytes=100_000)
+    heavy.record(5_000_000, 1, 5)
+    # tiny, fast records get clamped to the max
+    light = PageSizer(min_size=10, max_size=500, target_bytes=100_000)
+    light.record(1_000, .01, 10)
+    # pages without records are ignored
+    light.record(0, 1, 0)
+    assert all([initial == 100,
+                by_bytes == 100,
+                heavy.size() == 10,
+                light.size() == 500])
+
+
+def test_page_sizer_limits():
+    sizer = PageSizer()
+    sizer.set_limits(1, 50)
+    for bad in [(0, 50), (-1, 50), (1, 0), (60, 50)]:
+        with pytest.raises(ValueError):
+            sizer.set_limits(*bad)
+    # bad limits leave the old ones in place
+    assert all([sizer.size() == 50,
+                sizer.min_size == 1])
+
+
+def test_page_sizer_small_pages_after_large(monkeypatch):
+    # 0.3s a request, plus 2ms and 20kb a record
+    def fetch(sizer, nrecords, full_page):
+        sizer.record(20_000 * nrecords, .3 + .002 * nrecords, nrecords,
+                     full_page)
+
+    sizer = PageSizer()
+    for _ in range(25):
+        fetch(sizer, sizer.size(), True)
+    after_large = sizer.size()
+    # collections with a few works are one partial page each
+    for nrecords in [1, 3, 2]:
+        fetch(sizer, nrecords, False)
+    assert all([after_large == 250,
+                sizer.size() == 250])
+
+
+def test_build_params_page_size(monkeypatch):
+    sizer = PageSizer()
+    monkeypatch.setattr('nuldc.helpers.page_sizer', sizer)
+    # one query per run, so nuldc starts paging at the old size of 200
+    initial = build_params('opensearch', True, None, None)['size']
+    single = build_params('opensearch', False, None, None)['size']
+    # --max-size and --min-size clamp it
+    sizer.set_limits(10, 50)
+    max_clamped = build_params('opensearch', True, None, None)['size']
+    sizer.set_limits(300, 500)
+    min_clamped = build_params('opensearch', True, None, None)['size']
+    assert all([initial == '200',
+                single == '200',
+                max_clamped == '50',
+                min_clamped == '300'])
+
+
+def test_get_all_search_results_records_page_sizes(requests_mock,
+                                                  mock_dcapi, monkeypatch):
+    sizer = PageSizer()
+    monkeypatch.setattr('nuldc.helpers.page_sizer', sizer)
+    full_page = mock_dcapi("http://test.com/last")
+    full_page['pagination']['limit'] = "2"
+    last_page = mock_dcapi("")
+    last_page['data'].pop()
+    requests_mock.get('http://test.com/next', json=full_page)
+    requests_mock.get('http://test.com/last', json=last_page)
+    get_all_search_results(mock_dcapi("http://test.com/next"))
+    measured = sizer.seconds_per_record
+    # the partial last page only counts toward bytes
+    sizer.record(1, 100, 1, full_page=False)
+    assert all([sizer.bytes_per_record > 0,
+                measured is not None,
+                sizer.seconds_per_record == measured])
+
+
+def test_atomic_open(tmp_path):
+    out = tmp_path / "out.txt"
+    out.write_text("old")
+    with atomic_open(out, 'w') as f:
+        f.write("new")
+    # a failed write leaves the old file and no temp files
+    with pytest.raises(ValueError):
+        with atomic_open(out, 'w') as f:
+            f.write("partial")
+            raise ValueError
+    new_file = tmp_path / "new.txt"
+    with atomic_open(new_file, 'w') as f:
+        f.write("new")
+    assert all([out.read_text() == "new",
+                sorted(os.listdir(tmp_path)) == ["new.txt", "out.txt"],
+                new_file.stat().st_mode & 0o777 == 0o666 & ~helpers.UMASK])
+
+
+def test_atomic_open_special_paths(tmp_path):
+    target = tmp_path / "target.csv"
+    target.write_text("old")
+    target.chmod(0o640)
+    link = tmp_path / "link.csv"
+    link.symlink_to(target)
+    with atomic_open(link, 'w') as f:
+        f.write("new")
+    # devices are written to, not replaced
+    with atomic_open(os.devnull, 'w') as f:
+        f.write("new")
+    assert all([link.is_symlink(),
+                target.read_text() == "new",
+                target.stat().st_mode & 0o777 == 0o640,
+                not os.path.isfile(os.devnull)])
+
+
+def test_save_files_skips_unchanged(tmp_path, monkeypatch, mock_dcapi):
+    monkeypatch.chdir(tmp_path)
+    manifest = {}
+    first = dump.save_files("col", mock_dcapi(""), manifest)
+    second = dump.save_files("col", mock_dcapi(""), dump.load_manifest())
+    changed = mock_dcapi("")
+    changed['data'][0]['title'] = "new title"
+    third = dump.save_files("col", changed, dump.load_manifest())
+    assert all([first, not second, third,
+                os.path.isfile("csv/col.csv"),
+                dump.load_manifest() == {"col": dump.records_hash(changed)}])
+
+
+def test_dump_collections_saves_high_water_mark(requests_mock, tmp_path,
+                                                monkeypatch, mock_dcapi):
+    monkeypatch.chdir(tmp_path)
+    latest = {"value": 1700000000123.0,
+              "value_as_string": "2023-11-14T22:13:20.123Z"}
+    search = requests_mock.post(f"{dump.API}/search", json={"aggregations": {
+        "collection.id": {"buckets": [
+            {"key": "abc", "doc_count": 2, "indexed_at": latest,
+             "recent": {"doc_count": 1}},
+            {"key": "old", "doc_count": 5, "indexed_at": {"value": 1.0},
+             "recent": {"doc_count": 0}}]}}})
+    works = mock_dcapi("")
+    for w in works['data']:
+        w['collection'] = {"title": "A Collection"}
+    requests_mock.get(f"{dump.API}/search/works", json=works)
+    dump.save_updated_at("2023-11-14")
+    dump.dump_collections(dump.load_updated_at(), overlap=300)
+    aggs = search.last_request.json()['aggs']['collection.id']['aggs']
+    assert all([aggs['recent'] == {"filter": {"range": {
+                    "indexed_at": {"gte": "2023-11-14||-300s"}}}},
+                os.listdir("json") == ["a-collection-abc.json"],
+                dump.load_updated_at() == "2023-11-14T22:13:20.123Z"])
+
+
+def indexed_at(value, works=1):
+    """a collection like changed_collections returns"""
+    return {"value": value, "value_as_string": f"t{value}", "works": works}
+
+
+@pytest.fixture
+def watcher(tmp_path, monkeypatch):
+    """A Watcher in an empty folder whose polls return whatever is in
+    changes and whose dumps are recorded in dumped"""
+
+    monkeypatch.chdir(tmp_path)
+    changes, dumped = {}, []
+
+    def fake_changed_collections(since=None, overlap=0):
+        latest = max(changes.values(), key=lambda i: i['value'],
+                     default={})
+        return dict(changes), latest.get('value_as_string')
+
+    monkeypatch.setattr(dump, 'changed_collections', fake_changed_collections)
+    monkeypatch.setattr(dump, 'save_collection',
+                        lambda col_id, manifest: dumped.append(col_id))
+    return dump.Watcher(queue_size=10), changes, dumped
+
+
+def drain(w):
+    items = []
+    while not w.work.empty():
+        items.append(w.work.get())
+        w.apply(items[-1])
+    return items
+
+
+def test_watcher_poll_skips_unchanged_and_queues_newer(watcher):
+    w, changes, dumped = watcher
+    w.applied = {"a": (2, 1), "b": (2, 1)}
+    changes.update({"a": indexed_at(2), "b": indexed_at(3)})
+    w.poll()
+    items = drain(w)
+    assert all([items == [("b", indexed_at(3)), (None, ("t3", {"a", "b"}))],
+                dumped == ["b"],
+                w.applied == {"a": (2, 1), "b": (3, 1)},
+                dump.load_updated_at() == "t3"])
+
+
+def test_watcher_dumps_late_works(watcher):
+    w, changes, dumped = watcher
+    changes["a"] = indexed_at(5)
+    w.poll()
+    drain(w)
+    # a work indexed before the last one shows up in search late, so the
+    # max is the same but the collection has another work
+    changes["a"] = indexed_at(5, works=2)
+    w.poll()
+    drain(w)
+    w.poll()
+    drain(w)
+    assert dumped == ["a", "a"]
+
+
+def test_watcher_poll_does_not_queue_pending_twice(watcher):
+    w, changes, dumped = watcher
+    changes["a"] = indexed_at(1)
+    w.poll()
+    w.poll()
+    # a newer change while the old one is pending is queued behind it
+    changes["a"] = indexed_at(2)
+    w.poll()
+    items = drain(w)
+    assert all([[i[0] for i in items] == ["a", None, None, "a", None],
+                w.queued == {},
+                w.applied == {"a": (2, 1)}])
+
+
+def test_watcher_holds_checkpoint_back_on_failure(watcher, monkeypatch):
+    w, changes, dumped = watcher
+
+    def fail_on_a(col_id, manifest):
+        if col_id == "a":
+            # the paging helpers exit on errors
+            sys.exit(1)
+        dumped.append(col_id)
+
+    monkeypatch.setattr(dump, 'save_collection', fail_on_a)
+    changes.update({"a": indexed_at(1), "b": indexed_at(2)})
+    w.poll()
+    drain(w)
+    held_back = dump.load_updated_at()
+
+    # a is retried on the next poll and b is left alone
+    monkeypatch.setattr(dump, 'save_collection',
+                        lambda col_id, manifest: dumped.append(col_id))
+    w.poll()
+    drain(w)
+    assert all([held_back == "t1",
+                dumped == ["b", "a"],
+                w.failed == {},
+                dump.load_updated_at() == "t2"])
+
+
+def test_watcher_drops_failures_that_stop_changing(watcher, monkeypatch):
+    w, changes, dumped = watcher
+    monkeypatch.setattr(dump, 'save_collection',
+                        lambda col_id, manifest: sys.exit(1))
+    changes.update({"a": indexed_at(1), "b": indexed_at(2)})
+    w.poll()
+    drain(w)
+    held_back = dump.load_updated_at()
+    # a's works were deleted, so it won't come back to be retried
+    del changes["a"]
+    changes["b"] = indexed_at(3)
+    monkeypatch.setattr(dump, 'save_collection',
+                        lambda col_id, manifest: dumped.append(col_id))
+    w.poll()
+    drain(w)
+    assert all([held_back == "t1",
+                w.failed == {},
+                dump.load_updated_at() == "t3"])
+
+
+def test_watcher_worker_survives_errors(watcher, monkeypatch):
+    w, changes, dumped = watcher
+    saves = []
+
+    def broken_save(updated_at):
+        saves.append(updated_at)
+        raise OSError("disk full")
+
+    monkeypatch.setattr(dump, 'save_updated_at', broken_save)
+    monkeypatch.setattr(dump, 'save_collection',
+                        lambda col_id, manifest: sys.exit(1))
+    w.since = "t1"
+    for item in [(None, ("t1", set())), (None, ("t2", set())),
+                 ("a", indexed_at(3)), dump.Watcher.STOP]:
+        w.work.put(item)
+    # returns at STOP instead of dying on the way
+    w.work_forever()
+    assert all([w.work.empty(),
+                w.failed == {"a": indexed_at(3)},
+                # the unchanged mark isn't rewritten
+                saves == ["t2"]])